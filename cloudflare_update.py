@@ -1,6 +1,30 @@
 import os
+import html
+import json
+import time
+import queue
+import hashlib
+import ipaddress
+import sys
 import requests
+import threading
+from collections import defaultdict
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass
 from datetime import datetime, timedelta
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    import orjson  # 可选依赖，解析/序列化更快
+
+    json_loads, json_dumps = orjson.loads, orjson.dumps
+except ImportError:
+    json_loads = json.loads
+
+    def json_dumps(obj) -> bytes:
+        return json.dumps(obj).encode()
 
 # ------------------------- 配置区 -------------------------
 cf_tokens_str = os.getenv("CF_TOKENS", "").strip()
@@ -13,20 +37,118 @@ CHAT_ID = os.getenv("CHAT_ID", "").strip()
 if not BOT_TOKEN or not CHAT_ID:
     raise Exception("Telegram BOT_TOKEN 或 CHAT_ID 未设置")
 
+FORCE_SYNC = "--force" in sys.argv or os.getenv("FORCE_SYNC", "").strip() == "1"  # 忽略内容哈希，强制同步
+
 IP_LIST_URL = "https://raw.githubusercontent.com/yifangip/CF-PROXYIP/refs/heads/main/filtered_ips.txt"
 
+DNS_TYPES = {"v4": "A", "v6": "AAAA"}  # IP 版本对应的记录类型
+SUBDOMAIN_PREFIX = "proxyip"  # 子域名前缀，记录名为 proxyip.<国家代码>.<域名>
+
 MAX_IPS_PER_SUBDOMAIN = 150  # 避免 Cloudflare 记录超限，每个子域名最多添加多少 IP
+MAX_BATCH_OPERATIONS = 200   # Cloudflare 批量接口单次请求最多操作数（免费套餐上限 200）
+MAX_RECORD_PAGES = 20        # 列出记录时最多翻页数（每页 5000 条），防止异常响应导致无限翻页
+SUBDOMAIN_WORKERS = 8        # 同一域区内并发更新的子域名数量
+CF_RATE_LIMIT = 4            # 每个 token 平均每秒最多请求数（Cloudflare 限制为 5 分钟 1200 次）
+CF_RATE_BURST = 20           # 允许的突发请求数，少量记录变更时无需等待
+TOKEN_WORKERS = max(1, min(8, len(api_tokens)))  # 并行处理的 token 数量
+TG_FLUSH_TIMEOUT = 60        # 结束时等待 Telegram 队列发送完成的最长秒数
+TG_MESSAGE_LIMIT = 4000      # 单条消息最多字符数（Telegram 上限 4096，留出余量）
+TG_ERROR_CHARS = 500         # 汇总消息中每条错误最多保留的字符数（转义前截断）
+
+CACHE_DIR = ".cache"                                      # 跨运行缓存目录（工作流中由 actions/cache 保存）
+CACHE_META_FILE = os.path.join(CACHE_DIR, "cloudflare_update.json")
+IP_LIST_CACHE_FILE = os.path.join(CACHE_DIR, "ip_list.txt")
+ZONE_CACHE_TTL = 24 * 3600                                # 域区信息缓存有效期（秒）
+FULL_SYNC_INTERVAL = 7 * 24 * 3600                        # IP 列表未变时，每隔多久仍完整同步一次以修复手动改动的记录（秒）
+
+# ------------------------- HTTP 会话 -------------------------
+def _new_session(pool_maxsize: int) -> requests.Session:
+    """创建带连接池和重试的会话，复用 TLS 连接"""
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=pool_maxsize,
+        max_retries=Retry(
+            total=5,
+            backoff_factor=0.5,
+            status_forcelist=[429, 500, 502, 503, 504],
+            allowed_methods=["GET", "POST", "DELETE"],
+            respect_retry_after_header=True,  # 被限流时按 Retry-After 等待
+        ),
+    )
+    session.mount("https://", adapter)
+    return session
+
+
+HTTP_SESSION = _new_session(4)  # IP 列表下载；Cloudflare 请求由每个 token 各自的会话发出
+TG_SESSION = _new_session(4)    # Telegram 单独使用，避免与 Cloudflare 请求互相阻塞
+
+# ------------------------- 本地缓存 -------------------------
+def load_cache() -> dict:
+    """读取缓存元数据（ETag、域区信息），不存在或损坏时返回空缓存"""
+    try:
+        with open(CACHE_META_FILE, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_cache() -> None:
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        with open(CACHE_META_FILE, "w", encoding="utf-8") as f:
+            json.dump(cache, f)
+    except OSError as e:
+        print(f"缓存写入失败: {e}")
+
+
+cache = load_cache()
+
+
+def configs_hash(configs: dict) -> str:
+    """期望 DNS 状态（子域名、IP、token）的摘要，用于判断本次运行是否需要同步"""
+    state = sorted((sub, version, tuple(ips)) for sub, versions in configs.items() for version, ips in versions.items())
+    tokens = sorted(hashlib.sha256(token.encode()).hexdigest() for token in api_tokens)
+    return hashlib.blake2b(repr((state, tokens)).encode()).hexdigest()
+
 
 # ------------------------- Telegram 推送 -------------------------
+def split_message(text: str, limit: int = TG_MESSAGE_LIMIT) -> list:
+    """按行拆分超长消息，每段不超过 limit 个字符；单行超长时再按长度切开，切点不落在 &...; 实体内部"""
+    chunks, current = [], ""
+    for line in text.split("\n"):
+        start = 0
+        while True:
+            end = start + limit
+            if end < len(line):
+                # 切点前最后一个 & 之后没有 ; 说明实体被截断，退到 & 之前切
+                amp = line.rfind("&", start, end)
+                if amp > start and line.find(";", amp, end) == -1:
+                    end = amp
+            piece = line[start:end]
+            start = end
+            if current and len(current) + 1 + len(piece) > limit:
+                chunks.append(current)
+                current = piece
+            else:
+                current = f"{current}\n{piece}" if current else piece
+            if start >= len(line):
+                break
+    if current:
+        chunks.append(current)
+    return chunks
+
+
 def send_telegram_message(text: str) -> None:
-    """发送文本消息到 Telegram"""
+    """发送文本消息到 Telegram，超长时拆成多条按顺序发送"""
     url = f"https://api.telegram.org/bot{BOT_TOKEN}/sendMessage"
-    params = {"chat_id": CHAT_ID, "text": text, "parse_mode": "HTML"}
-    response = requests.get(url, params=params)
-    if response.status_code != 200:
-        print(f"Telegram 推送失败: {response.status_code} {response.text}")
-    else:
-        print("Telegram 推送成功")
+    for chunk in split_message(text):
+        params = {"chat_id": CHAT_ID, "text": chunk, "parse_mode": "HTML"}
+        response = TG_SESSION.post(url, data=params)  # 放在请求体中，长消息编码后不会超出 URL 长度限制
+        if response.status_code != 200:
+            print(f"Telegram 推送失败: {response.status_code} {response.text}")
+        else:
+            print("Telegram 推送成功")
 
 
 def send_telegram_file(file_path: str, ip_counts: dict, total_ips: int) -> None:
@@ -46,129 +168,351 @@ def send_telegram_file(file_path: str, ip_counts: dict, total_ips: int) -> None:
     with open(file_path, "rb") as f:
         files = {"document": f}
         data = {"chat_id": CHAT_ID, "caption": caption, "parse_mode": "HTML"}
-        response = requests.post(url, files=files, data=data)
+        response = TG_SESSION.post(url, files=files, data=data)
         if response.status_code != 200:
             print(f"Telegram 文件上传失败: {response.status_code} {response.text}")
         else:
             print("Telegram 文件上传成功")
 
 
+# 后台线程依次发送 Telegram 消息，避免阻塞 Cloudflare 更新
+tg_queue = queue.Queue()
+
+
+def _tg_worker() -> None:
+    while True:
+        task = tg_queue.get()
+        if task is None:
+            break
+        func, args = task
+        try:
+            func(*args)
+        except Exception as e:
+            print(f"Telegram 推送异常: {e}")
+
+
+tg_thread = threading.Thread(target=_tg_worker, daemon=True)
+tg_thread.start()
+
+
+def flush_telegram_queue(timeout: float = TG_FLUSH_TIMEOUT) -> None:
+    """等待队列中的 Telegram 消息发送完毕（最多 timeout 秒）"""
+    tg_queue.put(None)
+    tg_thread.join(timeout)
+
+
 # ------------------------- Cloudflare 函数 -------------------------
-def fetch_zone_info(api_token: str) -> tuple:
-    headers = {"Authorization": f"Bearer {api_token}", "Content-Type": "application/json"}
-    response = requests.get("https://api.cloudflare.com/client/v4/zones", headers=headers)
+class TokenBucket:
+    """令牌桶限速：平均每秒 rate 次，最多突发 burst 次；多线程共享"""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.capacity = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self) -> None:
+        """取一个令牌，没有可用令牌时等待到下一个令牌生成"""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # 令牌不足时预支（余量可为负），锁外等待，后来者自动排在后面
+            wait = (1 - self.tokens) / self.rate if self.tokens < 1 else 0
+            self.tokens -= 1
+        if wait:
+            time.sleep(wait)
+
+
+@dataclass(frozen=True, slots=True)
+class TokenCtx:
+    """单个 API Token 的处理上下文，每个 token 只构造一次"""
+    zone_id: str
+    domain: str
+    headers: Mapping[str, str]
+    session: requests.Session
+    bucket: TokenBucket  # 该 token 所有 Cloudflare 请求共用的限速器
+
+
+def fetch_zone_info(session: requests.Session, api_token: str, headers: Mapping[str, str]) -> tuple:
+    # 以 token 摘要为键缓存域区信息，避免每次运行都查询 /zones
+    token_key = hashlib.sha256(api_token.encode()).hexdigest()
+    cached = cache.setdefault("zones", {}).get(token_key)
+    if cached and time.time() - cached["ts"] < ZONE_CACHE_TTL:
+        return cached["id"], cached["name"]
+
+    response = session.get("https://api.cloudflare.com/client/v4/zones", headers=headers)
     response.raise_for_status()
-    zones = response.json().get("result", [])
+    zones = json_loads(response.content).get("result", [])
     if not zones:
         raise Exception("未找到域区信息")
+    cache["zones"][token_key] = {"id": zones[0]["id"], "name": zones[0]["name"], "ts": time.time()}
     return zones[0]["id"], zones[0]["name"]
 
 
-def fetch_subdomain_configs(url: str):
-    response = requests.get(url)
-    response.raise_for_status()
-    lines = response.text.strip().split('\n')
+def iter_ip_list(url: str):
+    """流式逐行读取 IP 列表，边下载边解析；带 ETag/Last-Modified 条件请求，304 时复用本地缓存"""
+    meta = cache.get("ip_list", {})
+    headers = {}
+    if meta.get("url") == url and os.path.exists(IP_LIST_CACHE_FILE):
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+
+    with HTTP_SESSION.get(url, headers=headers, stream=True) as response:
+        if response.status_code == 304:
+            print("IP 列表未变化，使用本地缓存")
+            with open(IP_LIST_CACHE_FILE, encoding="utf-8") as f:
+                for line in f:
+                    yield line.rstrip("\n")
+            return
+
+        response.raise_for_status()
+        response.encoding = "utf-8"
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        tmp_file = IP_LIST_CACHE_FILE + ".tmp"
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            for line in response.iter_lines(chunk_size=8192, decode_unicode=True):
+                f.write(line + "\n")
+                yield line
+        # 完整下载后才替换缓存，避免中断时留下残缺文件
+        os.replace(tmp_file, IP_LIST_CACHE_FILE)
+        cache["ip_list"] = {
+            "url": url,
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+        }
 
-    configs, ip_counts, total_ips, log_entries = {}, {}, 0, []
 
-    for line in lines:
-        if not line.strip() or "#" not in line:
+def fetch_subdomain_configs(url: str):
+    configs = defaultdict(dict)  # {子域名: {"v4"/"v6": {ip: None}}}，dict 作有序集合：去重并保留原始顺序
+    ip_counts = defaultdict(int)
+    log_entries = []  # (country, ip, latency)，写日志时再格式化
+
+    for line in iter_ip_list(url):
+        # 行格式: ip:port#CC#延迟:123ms（IPv6 为 [ip]:port）
+        ip_raw, sep, rest = line.partition("#")
+        if not sep:
+            continue
+        ip_raw = ip_raw.strip()
+        if ip_raw.startswith("["):
+            ip = ip_raw[1:].partition("]")[0]
+        else:
+            ip = ip_raw.partition(":")[0]
+        country, _, extra = rest.partition("#")
+        country = country.strip().lower()
+        if not country:
             continue
 
-        ip_raw, country = line.strip().split("#", 1)
-        ip_info = ip_raw.split(":")
-        ip = ip_info[0].strip()
+        # 本地校验 IP，无效条目不提交给 Cloudflare
+        try:
+            addr = ipaddress.ip_address(ip)
+        except ValueError:
+            continue
+        ip = str(addr)
 
         # 提取延迟
-        latency = ""
-        if "延迟" in country:
-            latency = country.split("延迟")[1].strip()
-            country = country.split('#')[0].strip()
-
-        if not latency:
-            latency = "未知"
+        latency = extra.partition("延迟")[2].lstrip(":：").strip() or "未知"
 
-        country = country.split('#')[0].strip().lower()
-        if not ip or not country:
+        ips = configs[f"{SUBDOMAIN_PREFIX}.{country}"].setdefault(f"v{addr.version}", {})
+        if ip in ips:
             continue
+        ips[ip] = None
+        ip_counts[country] += 1
+        log_entries.append((country, ip, latency))
 
-        cf_subdomain = f"proxyip.{country}"
-        tg_subdomain = f"proxyip.{country}.yifang.filegear-sg.me"
-
-        if cf_subdomain not in configs:
-            configs[cf_subdomain] = {"v4": []}
-        configs[cf_subdomain]["v4"].append(ip)
-        ip_counts[country] = ip_counts.get(country, 0) + 1
-        total_ips += 1
+    total_ips = sum(ip_counts.values())
+    configs = {sub: {version: list(ips) for version, ips in versions.items()} for sub, versions in configs.items()}
+    return configs, dict(ip_counts), total_ips, log_entries
 
-        log_entries.append(f"{tg_subdomain} → {ip} → 延迟:{latency}")
 
-    return configs, ip_counts, total_ips, log_entries
+def fetch_records_page(ctx: TokenCtx, page) -> dict:
+    """获取一页 DNS 记录的原始响应；只列出本脚本管理的子域名记录，由服务端过滤"""
+    query_url = (
+        f"https://api.cloudflare.com/client/v4/zones/{ctx.zone_id}/dns_records"
+        f"?per_page=5000&page={page}&name.startswith={SUBDOMAIN_PREFIX}."
+    )
+    ctx.bucket.acquire()
+    response = ctx.session.get(query_url, headers=ctx.headers)
+    response.raise_for_status()
+    return json_loads(response.content)
+
+
+def fetch_all_records(ctx: TokenCtx) -> dict:
+    """分页列出域区内受管子域名的 DNS 记录，返回 {(name, type): [(record_id, content), ...]}"""
+    first = fetch_records_page(ctx, 1)
+    pages = [first]
+    # 第一页返回总页数后，其余页并发获取
+    total_pages = min(first.get("result_info", {}).get("total_pages", 1), MAX_RECORD_PAGES)
+    if total_pages > 1:
+        with ThreadPoolExecutor(max_workers=min(SUBDOMAIN_WORKERS, total_pages - 1)) as executor:
+            pages += executor.map(lambda page: fetch_records_page(ctx, page), range(2, total_pages + 1))
+
+    records = {}
+    for data in pages:
+        for record in data.get("result", []):
+            records.setdefault((record["name"], record["type"]), []).append((record["id"], record["content"]))
+    return records
+
+
+def batch_update_subdomain(ctx: TokenCtx, full_name, dns_type, new_ips, zone_records) -> tuple:
+    """只提交与现有记录的差异：删除多余记录、添加缺少的 IP，并同步更新 zone_records。
+    返回 (添加数, 删除数, 错误列表)"""
+    batch_url = f"https://api.cloudflare.com/client/v4/zones/{ctx.zone_id}/dns_records/batch"
+    key = (full_name, dns_type)
+
+    desired = new_ips[:MAX_IPS_PER_SUBDOMAIN]
+    desired_set = set(desired)
+    existing = zone_records.get(key, [])
+    existing_ips = {content for _, content in existing}
+
+    to_delete = [rid for rid, content in existing if content not in desired_set]
+    to_add = [ip for ip in desired if ip not in existing_ips]
+    if not to_delete and not to_add:
+        print(f"{full_name} {dns_type} 记录无变化，跳过")
+        return 0, 0, []
+
+    # 同一子域名的记录只有 content 不同，模板只构造一次
+    base = {"type": dns_type, "name": full_name, "ttl": 1, "proxied": False}
+    operations = [("deletes", {"id": rid}) for rid in to_delete]
+    operations += [("posts", {**base, "content": ip}) for ip in to_add]
+
+    added, deleted_count, errors = 0, 0, []
+    # 单次批量请求的操作数有上限，超出时分批提交（删除在前，添加在后）
+    for start in range(0, len(operations), MAX_BATCH_OPERATIONS):
+        payload = {"deletes": [], "posts": []}
+        for op, item in operations[start:start + MAX_BATCH_OPERATIONS]:
+            payload[op].append(item)
+
+        ctx.bucket.acquire()
+        resp = ctx.session.post(batch_url, headers=ctx.headers, data=json_dumps(payload))
+        data = json_loads(resp.content) if resp.status_code == 200 else {}
+        if data.get("success"):
+            result = data.get("result") or {}
+            deleted = {item["id"] for item in payload["deletes"]}
+            records = [(rid, content) for rid, content in zone_records.get(key, []) if rid not in deleted]
+            records += [(record["id"], record["content"]) for record in result.get("posts") or []]
+            zone_records[key] = records
+            added += len(payload["posts"])
+            deleted_count += len(payload["deletes"])
+            print(f"批量更新 {full_name} {dns_type} 记录: 删除 {len(payload['deletes'])} 条, 添加 {len(payload['posts'])} 条")
+        else:
+            error = f"批量更新 {dns_type} 记录失败: {full_name} 错误 {resp.status_code} {resp.text}"
+            errors.append(error)
+            print(error)
 
+    return added, deleted_count, errors
 
-def update_dns_record(api_token, zone_id, subdomain, domain, dns_type, operation, ip_list=None):
-    headers = {"Authorization": f"Bearer {api_token}", "Content-Type": "application/json"}
-    full_name = domain if subdomain == "@" else f"{subdomain}.{domain}"
 
-    if operation == "delete":
-        while True:
-            query_url = f"https://api.cloudflare.com/client/v4/zones/{zone_id}/dns_records?type={dns_type}&name={full_name}"
-            response = requests.get(query_url, headers=headers)
-            response.raise_for_status()
-            records = response.json().get("result", [])
-            if not records:
-                break
-            for record in records:
-                delete_url = f"https://api.cloudflare.com/client/v4/zones/{zone_id}/dns_records/{record['id']}"
-                requests.delete(delete_url, headers=headers)
-                print(f"删除 {subdomain} {dns_type} 记录: {record['id']}")
-
-    elif operation == "add" and ip_list:
-        ip_list = ip_list[:MAX_IPS_PER_SUBDOMAIN]
-        for ip in ip_list:
-            payload = {"type": dns_type, "name": full_name, "content": ip, "ttl": 1, "proxied": False}
-            resp = requests.post(
-                f"https://api.cloudflare.com/client/v4/zones/{zone_id}/dns_records",
-                headers=headers,
-                json=payload
-            )
-            if resp.status_code in (200, 201):
-                print(f"添加 {subdomain} {dns_type} 记录: {ip}")
-            else:
-                print(f"添加 {dns_type} 记录失败: {subdomain} IP {ip} 错误 {resp.status_code} {resp.text}")
+# ------------------------- 主函数 -------------------------
+def process_token(idx, token, configs) -> int:
+    """处理单个 API Token 对应的域区；每个 token 使用独立会话，互不共享连接池。返回失败条数"""
+    headers = {"Authorization": f"Bearer {token}", "Content-Type": "application/json"}
+    with _new_session(SUBDOMAIN_WORKERS) as session:
+        print("=" * 50)
+        print(f"开始处理 API Token #{idx}")
+        zone_id, domain = fetch_zone_info(session, token, headers)
+        print(f"域区 ID: {zone_id} | 域名: {domain}")
+        ctx = TokenCtx(zone_id, domain, headers, session, TokenBucket(CF_RATE_LIMIT, CF_RATE_BURST))
+        zone_records = fetch_all_records(ctx)
+
+        # 期望状态：{(记录名, 类型): IP 列表}
+        desired = {}
+        for subdomain, version_ips in configs.items():
+            full_name = ctx.domain if subdomain == "@" else f"{subdomain}.{ctx.domain}"
+            for version, ip_list in version_ips.items():
+                desired[(full_name, DNS_TYPES[version])] = ip_list
+        # 列表只含受管前缀的记录；已不在期望状态中的 A/AAAA（如某国家已没有 IPv6 或整个国家下线）全部删除
+        managed_types = set(DNS_TYPES.values())
+        for key in zone_records:
+            if key[1] in managed_types:
+                desired.setdefault(key, [])
+
+        # 各子域名互不依赖，并发提交批量更新
+        changes, errors, unchanged = [], [], 0
+        with ThreadPoolExecutor(max_workers=SUBDOMAIN_WORKERS) as executor:
+            futures = {}
+            for (full_name, dns_type), ip_list in desired.items():
+                future = executor.submit(batch_update_subdomain, ctx, full_name, dns_type, ip_list, zone_records)
+                futures[future] = f"{full_name} {dns_type}"
+            for future in as_completed(futures):
+                added, deleted, sub_errors = future.result()
+                errors.extend(sub_errors)
+                if added or deleted:
+                    changes.append(f"• {futures[future]}: +{added} / -{deleted}")
+                elif not sub_errors:
+                    unchanged += 1
+
+        # 每个 token 只推送一条汇总消息
+        summary = [f"<b>Token #{idx}</b> {html.escape(ctx.domain)}"]
+        summary += [html.escape(line) for line in sorted(changes)]
+        summary.append(f"未变化: {unchanged} 个子域名")
+        if errors:
+            summary.append(f"<b>失败 {len(errors)} 条:</b>")
+            # 错误中含完整响应体，先截断再转义，避免消息过长或在转义实体中间被切开
+            summary += [
+                html.escape(error if len(error) <= TG_ERROR_CHARS else error[:TG_ERROR_CHARS] + "…")
+                for error in errors
+            ]
+        tg_queue.put((send_telegram_message, ("\n".join(summary),)))
+
+        print(f"结束处理 API Token #{idx}")
+        print("=" * 50 + "\n")
+        return len(errors)
 
 
-# ------------------------- 主函数 -------------------------
 def main():
     try:
         configs, ip_counts, total_ips, log_entries = fetch_subdomain_configs(IP_LIST_URL)
+        # 期望状态之外的受管记录会被删除，列表为空（下载或解析异常）时不能同步，否则会清空全部记录
+        if not configs:
+            raise Exception("IP 列表为空，已跳过 DNS 更新")
 
         # 写日志文件
         log_file_name = f"proxyip-{datetime.now().strftime('%Y-%m-%d')}.txt"
-        with open(log_file_name, "w") as f:
-            f.write("\n".join(log_entries))
-
-        # Telegram 上传日志文件并附带国家统计
-        send_telegram_file(log_file_name, ip_counts, total_ips)
-
-        # Cloudflare DNS 更新
-        for idx, token in enumerate(api_tokens, start=1):
-            print("=" * 50)
-            print(f"开始处理 API Token #{idx}")
-            zone_id, domain = fetch_zone_info(token)
-            print(f"域区 ID: {zone_id} | 域名: {domain}")
-
-            for subdomain, version_ips in configs.items():
-                for dns_type, ip_list in version_ips.items():
-                    update_dns_record(token, zone_id, subdomain, domain, "A", "delete")
-                    update_dns_record(token, zone_id, subdomain, domain, "A", "add", ip_list)
+        with open(log_file_name, "w", encoding="utf-8", buffering=1 << 20) as f:
+            f.writelines(
+                f"proxyip.{country}.yifang.filegear-sg.me → {ip} → 延迟:{latency}\n"
+                for country, ip, latency in log_entries
+            )
 
-            print(f"结束处理 API Token #{idx}")
-            print("=" * 50 + "\n")
+        # Telegram 上传日志文件并附带国家统计（后台发送，与 DNS 更新并行）
+        tg_queue.put((send_telegram_file, (log_file_name, ip_counts, total_ips)))
+
+        # 期望状态与上次成功同步时一致且未到完整同步间隔，则跳过全部 Cloudflare 请求
+        sync_hash = configs_hash(configs)
+        last_sync = cache.get("last_sync", {})
+        if (
+            not FORCE_SYNC
+            and last_sync.get("hash") == sync_hash
+            and time.time() - last_sync.get("ts", 0) < FULL_SYNC_INTERVAL
+        ):
+            print("IP 列表与上次同步一致，跳过 DNS 更新")
+            tg_queue.put((send_telegram_message, ("IP 列表无变化，已跳过 DNS 更新",)))
+            return
+
+        # Cloudflare DNS 更新：各 token 对应独立域区，并行处理
+        failures = 0
+        with ThreadPoolExecutor(max_workers=TOKEN_WORKERS) as executor:
+            futures = [
+                executor.submit(process_token, idx, token, configs)
+                for idx, token in enumerate(api_tokens, start=1)
+            ]
+            for future in as_completed(futures):
+                failures += future.result()
+
+        # 全部成功才记录哈希，失败时下次运行会重试
+        if not failures:
+            cache["last_sync"] = {"hash": sync_hash, "ts": time.time()}
 
     except Exception as e:
         print(f"错误: {e}")
-        send_telegram_message(f"错误: {e}")
+        tg_queue.put((send_telegram_message, (f"错误: {e}",)))
+    finally:
+        save_cache()
+        flush_telegram_queue()
 
 
 if __name__ == "__main__":
@@ -1,19 +1,135 @@
-import re
 import os
+import sys
+import json
+import heapq
+import time
+import random
+import atexit
+import logging
 import requests
 import threading
 from collections import defaultdict
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    from orjson import loads as json_loads  # 可选依赖，解析更快
+except ImportError:
+    from json import loads as json_loads
 
 # ------------------------- 配置区 -------------------------
-MAX_PER_COUNTRY = int(os.getenv("MAX_PER_COUNTRY", 2))  # 每个国家最大条数 默认2
+MAX_PER_COUNTRY = int(os.getenv("MAX_PER_COUNTRY") or 2)  # 每个国家最大条数 默认2
+MAX_CANDIDATES_PER_COUNTRY = int(os.getenv("MAX_CANDIDATES_PER_COUNTRY", 0))  # 每个国家最多参与验证的候选数 默认0不限
+# 所有已出现国家的候选都已满后，连续多少条候选仍属于已满国家即停止读取。
+# 仅适用于各国家交错排列的列表：按国家分组排序时，后面出现的国家会因提前停止而没有候选，此时应设为 0 关闭
+EARLY_EXIT_AFTER = int(os.getenv("EARLY_EXIT_AFTER", 300))
 IP_URL = "https://zip.cm.edu.kg/all.txt"                # 远程 IP 列表
-CHECK_API = "https://check.proxyip.cmliussss.net/check?proxyip={}"  # 验证 API
-MAX_THREADS = 2                                        # 每批次并发线程数 默认5
+CHECK_API_PREFIX = "https://check.proxyip.cmliussss.net/check?proxyip="  # 验证 API，后接 ip:port
+CHECK_TIMEOUT = (3, 6)                                  # 验证请求的 (连接, 读取) 超时秒数
+MAX_THREADS = int(os.getenv("MAX_THREADS") or 2)       # 验证并发线程数 默认2
+RANK_BY_LATENCY = os.getenv("RANK_BY_LATENCY", "").strip() == "1"  # 为1时按延迟挑选每个国家最快的 IP
+RANK_POOL_FACTOR = int(os.getenv("RANK_POOL_FACTOR", 3))  # 按延迟挑选时，先收集 MAX_PER_COUNTRY 的多少倍有效 IP
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()      # DEBUG 时输出每个 IP 的验证结果
+VERIFIED_CACHE_FILE = os.path.join(".cache", "verified_cache.json")  # 跨运行的验证结果缓存
+VERIFIED_CACHE_TTL = int(os.getenv("VERIFIED_CACHE_TTL", 6 * 3600))  # 有效结果的缓存有效期（秒）
+INVALID_CACHE_TTL = int(os.getenv("INVALID_CACHE_TTL", 7 * 24 * 3600))  # 无效结果的缓存有效期（秒），需长于工作流运行间隔
+REPROBE_RATE = float(os.getenv("REPROBE_RATE", 0.05))  # 命中无效缓存时仍重新验证的概率，让恢复的 IP 有机会回来
+SUCCESS_HISTORY_FILE = os.path.join(".cache", "success_history.json")  # 跨运行的每个 IP 历史验证成功率
+SUCCESS_HISTORY_TTL = int(os.getenv("SUCCESS_HISTORY_TTL", 30 * 24 * 3600))  # 超过多久未验证的 IP 从历史中删除（秒）
+
+# ------------------------- 日志 -------------------------
+# 每个 IP 的验证结果为 DEBUG 级别，默认不输出，避免大量逐行写 stdout 拖慢验证线程
+log = logging.getLogger("filter_ips")
+logging.basicConfig(level=LOG_LEVEL, format="%(message)s", stream=sys.stdout)  # 与原先 print 一样输出到 stdout
+
+# ------------------------- HTTP 会话 -------------------------
+# 复用到验证 API 的 keep-alive 连接，连接池大小与并发线程数一致；验证失败不重试
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(
+    pool_connections=1,
+    pool_maxsize=MAX_THREADS,
+    pool_block=False,  # 池满时新建连接而不是阻塞等待
+    max_retries=Retry(total=0),
+))
+
+# ------------------------- 缓存 -------------------------
+def load_verified_cache():
+    """读取上次运行的验证结果，丢弃已过期条目。条目格式: ip_port -> [有效, 延迟, 时间戳]"""
+    try:
+        with open(VERIFIED_CACHE_FILE, encoding="utf-8") as f:
+            entries = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    now = time.time()
+    return {
+        k: tuple(v) for k, v in entries.items()
+        if now - v[2] < (VERIFIED_CACHE_TTL if v[0] else INVALID_CACHE_TTL)
+    }
+
+
+def save_verified_cache():
+    # 时间戳为 None 的是请求异常结果，只在本次运行内复用，不写入磁盘
+    entries = {k: v for k, v in verified_cache.items() if v[2] is not None}
+    try:
+        os.makedirs(os.path.dirname(VERIFIED_CACHE_FILE), exist_ok=True)
+        with open(VERIFIED_CACHE_FILE, "w", encoding="utf-8") as f:
+            json.dump(entries, f)
+    except OSError as e:
+        log.warning(f"验证缓存写入失败: {e}")
+
+
+def _cache_usable(entry):
+    """缓存条目是否可直接使用：有效结果在 VERIFIED_CACHE_TTL 内可用；
+    无效结果在 INVALID_CACHE_TTL 内可用，但每次有 REPROBE_RATE 的概率重新验证"""
+    valid, _, ts = entry
+    if ts is None:  # 本次运行内的请求异常结果
+        return True
+    age = time.time() - ts
+    if valid:
+        return age < VERIFIED_CACHE_TTL
+    return age < INVALID_CACHE_TTL and random.random() >= REPROBE_RATE
+
+
+def load_success_history():
+    """读取每个 IP 的历史验证次数，丢弃长期未验证（多半已从列表中消失）的条目。
+    条目格式: ip_port -> [成功次数, 总次数, 最近验证时间戳]"""
+    try:
+        with open(SUCCESS_HISTORY_FILE, encoding="utf-8") as f:
+            entries = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    now = time.time()
+    return {k: v for k, v in entries.items() if len(v) == 3 and now - v[2] < SUCCESS_HISTORY_TTL}
+
+
+def save_success_history():
+    try:
+        os.makedirs(os.path.dirname(SUCCESS_HISTORY_FILE), exist_ok=True)
+        with open(SUCCESS_HISTORY_FILE, "w", encoding="utf-8") as f:
+            json.dump(success_history, f)
+    except OSError as e:
+        log.warning(f"历史成功率写入失败: {e}")
+
+
+def _success_rate_key(candidate):
+    """排序用：历史成功率高的候选排在前面；没有记录的按 50% 估计，排在确认失效的 IP 之前"""
+    success, total, _ = success_history.get(candidate[0], (0, 0, None))
+    return -(success + 1) / (total + 2)
+
+
+# 单条 dict 读写在 GIL 下是原子的，缓存写入无需加锁
+verified_cache = load_verified_cache()
+success_history = load_success_history()
+atexit.register(save_verified_cache)
+atexit.register(save_success_history)
+_inflight = {}  # 正在验证的 ip_port -> Future，同一 IP 并发验证时只请求一次
+
+# ------------------------- 线程池 -------------------------
+# 全部国家共用一个线程池，大小与 SESSION 连接池一致；退出时先等进行中的验证写完缓存再保存（atexit 后注册先执行）
+_EXECUTOR = ThreadPoolExecutor(max_workers=MAX_THREADS, thread_name_prefix="check")
+atexit.register(_EXECUTOR.shutdown)
 
-# ------------------------- 缓存 & 锁 -------------------------
-verified_cache = {}
-lock = threading.Lock()  # 用于多线程安全输出和列表操作
 
 def check_proxy(ip_port, stop_flag):
     """验证代理是否有效，并返回 (是否有效, 延迟ms)。如果 stop_flag 被设置则尽快返回。"""
@@ -21,13 +137,30 @@ def check_proxy(ip_port, stop_flag):
     if stop_flag.is_set():
         return False, -1
 
-    if ip_port in verified_cache:
-        return verified_cache[ip_port]
+    cached = verified_cache.get(ip_port)
+    if cached and _cache_usable(cached):
+        return cached[0], cached[1]
+
+    # 第一个线程放入 Future 并发起请求，其余线程等待同一结果（setdefault 在 GIL 下是原子的）
+    fut = _inflight.get(ip_port)
+    if fut is None:
+        new = Future()
+        fut = _inflight.setdefault(ip_port, new)
+        if fut is new:
+            try:
+                new.set_result(_request_check(ip_port, stop_flag))
+            finally:
+                # 结果已写入 verified_cache，后续调用直接命中缓存
+                _inflight.pop(ip_port, None)
+    return fut.result()
 
-    url = CHECK_API.format(ip_port)
+
+def _request_check(ip_port, stop_flag):
+    """调用验证 API 并写入 verified_cache，返回 (是否有效, 延迟ms)"""
+    url = CHECK_API_PREFIX + ip_port
     try:
-        resp = requests.get(url, timeout=6)
-        data = resp.json()
+        resp = SESSION.get(url, timeout=CHECK_TIMEOUT)
+        data = json_loads(resp.content)
 
         valid = (
             isinstance(data, dict)
@@ -35,125 +168,153 @@ def check_proxy(ip_port, stop_flag):
             and str(data.get("proxyIP")) != "-1"
         )
         delay = data.get("responseTime", -1)
-        verified_cache[ip_port] = (valid, delay)
+        verified_cache[ip_port] = (valid, delay, time.time())
+        # 同一 IP 同时只有一个线程在请求（见 _inflight），计数更新无需加锁
+        history = success_history.setdefault(ip_port, [0, 0, 0])
+        history[0] += valid
+        history[1] += 1
+        history[2] = time.time()
 
-        with lock:
-            status = "✅ 有效" if valid else "❌ 无效"
-            # 只有在没有 stop 的情况下打印，避免在达到 quota 后继续输出
-            if not stop_flag.is_set():
-                print(f"[{status}] {ip_port}  延迟: {delay}ms")
+        # 只有在没有 stop 的情况下输出，避免在达到 quota 后继续输出
+        # 使用惰性参数，未开启 DEBUG 时不格式化字符串
+        if not stop_flag.is_set():
+            log.debug("[%s] %s  延迟: %sms", "✅ 有效" if valid else "❌ 无效", ip_port, delay)
 
         return valid, delay
     except Exception as e:
-        with lock:
-            print(f"[⚠️ 验证失败] {ip_port} -> {e}")
-        verified_cache[ip_port] = (False, -1)
+        log.debug("[⚠️ 验证失败] %s -> %s", ip_port, e)
+        verified_cache[ip_port] = (False, -1, None)
         return False, -1
 
 
-def validate_batch(ip_batch, stop_flag):
+def validate_batch(ip_batch, stop_flag, checker=check_proxy, remaining_quota=None):
     """
-    对一小批 ip（原始行，如 '1.2.3.4:443#CC'）并发验证，
-    返回本批次中按出现顺序的有效行（已附带延迟）。
-    不会返回超过 remaining_quota（外部控制）。
+    对一组候选 [(ip_port, 原始行), ...]（如 ('1.2.3.4:443', '1.2.3.4:443#CC')）以 MAX_THREADS 并发验证，
+    按完成顺序返回有效结果 [(延迟ms, 附带延迟的行), ...]。
+    收集到 remaining_quota 条后置位 stop_flag 并取消尚未开始的验证，不等待进行中的请求。
+    checker(ip_port, stop_flag) -> (是否有效, 延迟ms)，默认调用验证 API。
     """
-    ip_ports = [line.split('#')[0] for line in ip_batch]
+    ip_to_line = dict(ip_batch)  # 解析时已拆出 ip_port，这里无需再 split；重复 IP 只验证一次
+    ip_ports = list(ip_to_line)
     valid_lines = []
-    with ThreadPoolExecutor(max_workers=min(MAX_THREADS, len(ip_ports))) as executor:
-        futures = {executor.submit(check_proxy, ip, stop_flag): ip for ip in ip_ports}
-        for future in as_completed(futures):
-            ip = futures[future]
-            try:
-                valid, delay = future.result()
-                if valid:
-                    # 找到对应的原始行（保持原始顺序以便后面截取）
-                    for line in ip_batch:
-                        if line.startswith(ip):
-                            valid_lines.append(f"{line}#延迟:{delay}ms")
-                            break
-                # 如果 stop_flag 已经被设定，则我们可以尽早返回
-                if stop_flag.is_set():
-                    break
-            except Exception as e:
-                with lock:
-                    print(f"[线程错误] {ip} -> {e}")
+    futures = {_EXECUTOR.submit(checker, ip, stop_flag): ip for ip in ip_ports}
+    for future in as_completed(futures):
+        ip = futures[future]
+        try:
+            valid, delay = future.result()
+            if valid:
+                valid_lines.append((delay, f"{ip_to_line[ip]}#延迟:{delay}ms"))
+                if remaining_quota is not None and len(valid_lines) >= remaining_quota:
+                    stop_flag.set()
+            # 如果 stop_flag 已经被设定，取消排队中的验证并尽早返回；进行中的请求不等待，其结果照常写入缓存
+            if stop_flag.is_set():
+                for pending in futures:
+                    pending.cancel()
+                break
+        except Exception as e:
+            log.warning(f"[线程错误] {ip} -> {e}")
     return valid_lines
 
 
-def validate_country(country, ip_lines, max_per_country):
-    """逐批次验证某个国家的 IP，严格控制最多 max_per_country 条有效 IP"""
-    print(f"\n🌍 验证 {country} 的 IP，目标数量: {max_per_country}")
+def validate_country(country, ip_lines, max_per_country, checker=check_proxy):
+    """验证某个国家的 IP，严格控制最多 max_per_country 条有效 IP"""
+    log.info(f"\n🌍 验证 {country} 的 IP，目标数量: {max_per_country}")
 
-    valid_results = []
+    # 按延迟挑选时多收集一些有效 IP，再从中取最快的 max_per_country 条
+    quota = max_per_country * RANK_POOL_FACTOR if RANK_BY_LATENCY else max_per_country
     stop_flag = threading.Event()
-    index = 0
-    total = len(ip_lines)
-
-    # 分批提交，每批次大小为 MAX_THREADS（并发数）
-    while len(valid_results) < max_per_country and index < total:
-        # 取下一批（按照原始顺序）
-        batch = ip_lines[index:index + MAX_THREADS]
-        valid_batch = validate_batch(batch, stop_flag)
-
-        # 按原始批次顺序把有效项加入结果，加入时检查上限
-        for line in valid_batch:
-            if len(valid_results) < max_per_country:
-                valid_results.append(line)
-                if len(valid_results) >= max_per_country:
-                    # 达到上限，置位 stop_flag 并跳出
-                    stop_flag.set()
-                    break
-            else:
-                break
 
-        # 如果已经达到上限，就不要再提交下一批
-        if stop_flag.is_set():
-            break
+    # 一次性提交全部候选，线程池始终满载，不再按批次等待每批中最慢的请求；达到 quota 后取消其余
+    valid_results = validate_batch(ip_lines, stop_flag, checker, quota)
 
-        index += MAX_THREADS
+    if RANK_BY_LATENCY:
+        valid_results = heapq.nsmallest(max_per_country, valid_results, key=_latency_key)
 
-    print(f"✅ {country} 有效 IP 数量: {len(valid_results)} / {max_per_country}")
-    return valid_results
+    log.info(f"✅ {country} 有效 IP 数量: {len(valid_results)} / {max_per_country}")
+    return [line for _, line in valid_results]
 
 
-def filter_ips(input_data, max_per_country=MAX_PER_COUNTRY):
-    """主流程：按国家分组并逐国家验证"""
-    lines = input_data.strip().split('\n')
+def _latency_key(result):
+    """排序用延迟：未知或异常延迟排在最后"""
+    delay = result[0]
+    return delay if isinstance(delay, (int, float)) and delay >= 0 else float("inf")
+
+
+def group_by_country(lines, max_candidates=MAX_CANDIDATES_PER_COUNTRY):
+    """解析并按国家分组，返回 {国家代码: [(ip_port, 原始行), ...]}。lines 为逐行 bytes 的可迭代对象（可直接传入流式响应）"""
     country_map = defaultdict(list)
+    saturated = set()  # 候选数已达 max_candidates 的国家
+    idle = 0           # 所有国家都已满后，连续解析出的已满国家候选数
 
-    for line in lines:
-        line = line.strip()
-        if not line or ':443#' not in line:
+    for raw in lines:
+        # 限制候选数时，所有已出现的国家都已满且长时间没有新国家，则提前结束读取
+        # （之后才出现的国家会被漏掉，见 EARLY_EXIT_AFTER 的说明）
+        if max_candidates and EARLY_EXIT_AFTER and idle >= EARLY_EXIT_AFTER and len(saturated) == len(country_map):
+            log.info(f"连续 {EARLY_EXIT_AFTER} 条候选均属于已满国家，提前停止读取 IP 列表")
+            break
+
+        # 先在 bytes 上过滤端口，被丢弃的行无需解码
+        if b':443#' not in raw:
+            continue
+        line = raw.decode('utf-8', 'replace').strip()  # 保留行中的非 ASCII 内容（如备注），原样写出
+        # 国家代码固定为行尾 "#XX" 两位大写字母，直接切片判断，无需正则
+        if line[-3] != '#':
             continue
-        match = re.search(r'#([A-Z]{2})$', line)
-        if match:
-            country = match.group(1)
-            country_map[country].append(line)
+        country = line[-2:]
+        if not ('A' <= country[0] <= 'Z' and 'A' <= country[1] <= 'Z'):
+            continue
+        country = sys.intern(country)  # 国家代码最多约 250 种，驻留后字典查找可走身份比较
+        if country in saturated:
+            # 只有能解析出候选的行才计数，其他端口或格式不符的行不影响提前结束
+            idle += 1
+            continue
+        candidates = country_map[country]
+        candidates.append((line.partition('#')[0], line))  # 第一个 # 之前即 ip:port（行中可能还有备注段）
+        idle = 0
+        if max_candidates and len(candidates) >= max_candidates:
+            saturated.add(country)
+
+    return country_map
 
-    result = []
+
+def filter_ips(country_map, out_file, max_per_country=MAX_PER_COUNTRY, checker=check_proxy):
+    """主流程：逐国家验证 group_by_country 的分组结果，有效行逐国家直接写入 out_file，返回写入条数"""
+    count = 0
     for country in sorted(country_map.keys()):
-        valid = validate_country(country, country_map[country], max_per_country)
-        result.extend(valid)
+        candidates = country_map[country]
+        if success_history:
+            # 历史上更常有效的 IP 先验证，更少的请求就能凑满配额；成功率相同时保持原顺序
+            candidates.sort(key=_success_rate_key)
+        valid = validate_country(country, candidates, max_per_country, checker)
+        if valid:
+            out_file.write('\n'.join(valid) + '\n')
+            count += len(valid)
 
-    return '\n'.join(result)
+    return count
 
 
 if __name__ == "__main__":
     output_file = "filtered_ips.txt"
+    tmp_file = output_file + ".tmp"
 
     try:
-        response = requests.get(IP_URL, timeout=15)
+        response = SESSION.get(IP_URL, timeout=15, stream=True)
         response.raise_for_status()
-        input_data = response.text
     except Exception as e:
-        print(f"无法获取远程 IP 列表: {e}")
+        log.error(f"无法获取远程 IP 列表: {e}")
         exit(1)
 
-    output_data = filter_ips(input_data)
+    # 边下载边解析，不在内存中保留完整文本；分组结束（含提前停止读取）后立即关闭连接，再开始验证
+    with response:
+        country_map = group_by_country(response.iter_lines(chunk_size=65536))
+
+    # 结果先写临时文件，没有有效代理时保留旧文件
+    with open(tmp_file, "w", encoding="utf-8") as f:
+        count = filter_ips(country_map, f)
 
-    if output_data.strip():
-        with open(output_file, "w", encoding="utf-8") as f:
-            f.write(output_data)
-        print(f"\n✅ 已生成 {output_file} 文件，共 {len(output_data.splitlines())} 条有效代理。")
+    if count:
+        os.replace(tmp_file, output_file)
+        log.info(f"\n✅ 已生成 {output_file} 文件，共 {count} 条有效代理。")
     else:
-        print("\n⚠️ 没有找到任何有效代理 IP。")
+        os.remove(tmp_file)
+        log.warning("\n⚠️ 没有找到任何有效代理 IP。")